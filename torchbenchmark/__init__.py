@@ -399,6 +399,14 @@ class ModelTask(base_task.TaskBase):
         else:
             return None
 
+    @base_task.run_in_worker(scoped=True)
+    @staticmethod
+    def get_model_attributes(attrs: List[str]) -> Dict[str, Any]:
+        """Fetch several model attributes in a single round-trip to the worker.
+        Missing attributes are returned as None."""
+        model = globals()["model"]
+        return {attr: getattr(model, attr, None) for attr in attrs}
+
     def gc_collect(self) -> None:
         self.worker.run(
             """
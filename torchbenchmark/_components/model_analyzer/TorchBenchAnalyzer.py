@@ -242,7 +242,11 @@ class ModelAnalyzer:
         # @Yueming Hao: print all collected gpu records, for debug only
         logger.debug(json.dumps([_.to_dict() for _ in self.gpu_records], indent=4))
 
-    def export_all_records_to_csv(self):
+    def export_all_records_to_csv(self, buffer_size: int = -1):
+        """
+        Export all GPU records to the csv file.
+        @param buffer_size: buffer size in bytes of the output file, -1 for the default.
+        """
         records_groupby_gpu = self.gpu_record_aggregator.groupby_wo_aggregate(
             self.gpu_metrics, lambda record: record.device_uuid()
         )
@@ -261,7 +265,7 @@ class ModelAnalyzer:
                     csv_records[gpu_uuid][record_type][
                         record.timestamp()
                     ] = record.value()
-        with open(self.export_csv_name, "w") as fout:
+        with open(self.export_csv_name, "w", buffering=buffer_size) as fout:
             for gpu_uuid in csv_records:
                 # timestamp record in DCGM is microsecond
                 timestamps = set()
@@ -5,17 +5,23 @@ Utilities to measure metrics of a model.
 import dataclasses
 import pathlib
 import time
-from typing import List, Optional, Tuple, Union
+import warnings
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from torchbenchmark import ModelTask
 from torchbenchmark.util.experiment.instantiator import TorchBenchModelConfig
 from torchbenchmark.util.model import BenchmarkModel
 
 WARMUP_ROUNDS = 10
+# relative difference between consecutive warm-up iterations to stop warming up
+WARMUP_TOLERANCE = 0.05
 BENCHMARK_ITERS = 15
 MEMPROF_ITER = 2
 NANOSECONDS_PER_MILLISECONDS = 1_000_000.0
+# write buffer size for exporting the monitor records
+EXPORT_BUFFER_SIZE = 1 << 20
 
 
 @dataclasses.dataclass
@@ -30,37 +36,93 @@ class TorchBenchModelMetrics:
     model_flops: Optional[float]
 
 
-def get_latencies(
-    func, device: str, nwarmup=WARMUP_ROUNDS, num_iter=BENCHMARK_ITERS
-) -> List[float]:
-    "Run one step of the model, and return the latency in milliseconds."
-    # Warm-up `nwarmup` rounds
-    for _i in range(nwarmup):
+def _get_latencies_cuda_events(func, num_iter: int) -> List[float]:
+    "Time `num_iter` runs of `func` with CUDA events, synchronizing only once."
+    starts = [torch.cuda.Event(enable_timing=True) for _ in range(num_iter)]
+    ends = [torch.cuda.Event(enable_timing=True) for _ in range(num_iter)]
+    for i in range(num_iter):
+        starts[i].record()
         func()
+        ends[i].record()
+    torch.cuda.synchronize()  # Wait for the events to be recorded!
+    # elapsed_time() already reports milliseconds
+    return [start.elapsed_time(end) for start, end in zip(starts, ends)]
+
+
+def _get_latencies_host(func, device: str, num_iter: int) -> List[float]:
+    "Time `num_iter` runs of `func` with the host clock."
     result_summary = []
     for _i in range(num_iter):
         if device == "cuda":
             torch.cuda.synchronize()
-            # Collect time_ns() instead of time() which does not provide better precision than 1
-            # second according to https://docs.python.org/3/library/time.html#time.time.
-            t0 = time.time_ns()
+            # Collect perf_counter_ns() instead of time_ns(): it is monotonic and does not jump
+            # on wall clock adjustments, see https://docs.python.org/3/library/time.html#time.perf_counter_ns.
+            t0 = time.perf_counter_ns()
             func()
             torch.cuda.synchronize()  # Wait for the events to be recorded!
-            t1 = time.time_ns()
+            t1 = time.perf_counter_ns()
         else:
-            t0 = time.time_ns()
+            t0 = time.perf_counter_ns()
             func()
-            t1 = time.time_ns()
+            t1 = time.perf_counter_ns()
         result_summary.append((t1 - t0) / NANOSECONDS_PER_MILLISECONDS)
     return result_summary
 
 
+def _cuda_events_available() -> bool:
+    try:
+        torch.cuda.Event(enable_timing=True)
+    except RuntimeError:
+        return False
+    return True
+
+
+def get_latencies(
+    func,
+    device: str,
+    nwarmup=WARMUP_ROUNDS,
+    num_iter=BENCHMARK_ITERS,
+    in_process: bool = True,
+) -> List[float]:
+    """Run one step of the model, and return the latency in milliseconds.
+    Warm-up is adaptive: it stops as soon as two consecutive warm-up iterations
+    agree within WARMUP_TOLERANCE, and runs at most `nwarmup` iterations.
+    CUDA events are only used when `func` launches its work in this process
+    (`in_process`); a ModelTask runs in a worker subprocess, so it is timed
+    with the host clock instead."""
+    # Fall back to host-side timing if CUDA events cannot be created
+    use_cuda_events = (
+        in_process
+        and device == "cuda"
+        and torch.cuda.is_available()
+        and _cuda_events_available()
+    )
+
+    def measure(n: int) -> List[float]:
+        if use_cuda_events:
+            return _get_latencies_cuda_events(func, n)
+        return _get_latencies_host(func, device, n)
+
+    # Warm-up iterations go through the same timer as the measured ones
+    prev_latency = None
+    for _i in range(nwarmup):
+        (latency,) = measure(1)
+        if (
+            prev_latency is not None
+            and prev_latency > 0
+            and abs(latency - prev_latency) / prev_latency < WARMUP_TOLERANCE
+        ):
+            break
+        prev_latency = latency
+    return measure(num_iter)
+
+
 def get_peak_memory(
     func,
     device: str,
     num_iter=MEMPROF_ITER,
     export_metrics_file="",
-    metrics_needed=[],
+    metrics_needed: Optional[List[str]] = None,
     metrics_gpu_backend="dcgm",
     cpu_monitored_pid=None,
 ) -> Tuple[Optional[float], Optional[str], Optional[float]]:
@@ -69,9 +131,8 @@ def get_peak_memory(
         ModelAnalyzer,
     )
 
-    new_metrics_needed = [
-        _ for _ in metrics_needed if _ in ["cpu_peak_mem", "gpu_peak_mem"]
-    ]
+    needed = frozenset(metrics_needed or ())
+    new_metrics_needed = [_ for _ in ["cpu_peak_mem", "gpu_peak_mem"] if _ in needed]
     if not new_metrics_needed:
         raise ValueError(
             f"Expected metrics_needed to be non-empty, get: {metrics_needed}"
@@ -81,39 +142,46 @@ def get_peak_memory(
     )
     continue_num_iter = BENCHMARK_ITERS - num_iter
 
-    def work_func():
+    def sync():
         if device == "cuda":
             torch.cuda.synchronize()
-            func()
-            torch.cuda.synchronize()
-        else:
-            func()
 
-    t0 = time.time_ns()
-    work_func()
-    t1 = time.time_ns()
+    # Warm up once so the probe below does not pay one-off costs
+    #  (JIT, cuBLAS handle init, etc.) and mis-classify the iteration count.
+    sync()
+    func()
+    sync()
+    t0 = time.perf_counter_ns()
+    func()
+    sync()
+    t1 = time.perf_counter_ns()
     # if total execution time is less than 15ms, we run the model for BENCHMARK_ITERS times
     #  to get more accurate peak memory
     if (t1 - t0) < 15 * NANOSECONDS_PER_MILLISECONDS:
         num_iter = BENCHMARK_ITERS
     else:
         num_iter = MEMPROF_ITER
+    # The monitor samples asynchronously, so only quiesce the device at the
+    #  boundaries of the monitored window instead of around every iteration.
+    sync()
     mem_model_analyzer.start_monitor()
-
     for _i in range(num_iter):
-        work_func()
+        func()
+    sync()
     mem_model_analyzer.stop_monitor()
     mem_model_analyzer.aggregate()
     device_id = None
     gpu_peak_mem = None
     cpu_peak_mem = None
-    if "gpu_peak_mem" in metrics_needed:
+    if "gpu_peak_mem" in needed:
         device_id, gpu_peak_mem = mem_model_analyzer.calculate_gpu_peak_mem()
-    if "cpu_peak_mem" in metrics_needed:
+    if "cpu_peak_mem" in needed:
         cpu_peak_mem = mem_model_analyzer.calculate_cpu_peak_mem()
     if export_metrics_file:
         mem_model_analyzer.update_export_name("_peak_memory")
-        mem_model_analyzer.export_all_records_to_csv()
+        mem_model_analyzer.export_all_records_to_csv(
+            buffer_size=EXPORT_BUFFER_SIZE
+        )
     return cpu_peak_mem, device_id, gpu_peak_mem
 
 
@@ -123,23 +191,17 @@ def get_model_flops(model: Union[BenchmarkModel, ModelTask]) -> float:
 
     flop_counter = FlopCounterMode()
 
-    def work_func():
-        if model.device == "cuda":
-            torch.cuda.synchronize()
-            model.invoke()
-            torch.cuda.synchronize()
-        else:
-            model.invoke()
-
+    # FlopCounterMode counts flops at dispatch time on the host,
+    #  so no device synchronization is needed around the invocation.
     with flop_counter:
-        work_func()
-    total_flops = sum([v for _, v in flop_counter.flop_counts["Global"].items()])
+        model.invoke()
+    total_flops = sum(flop_counter.flop_counts["Global"].values())
     return total_flops
 
 
 def get_model_test_metrics(
     model: Union[BenchmarkModel, ModelTask],
-    metrics=[],
+    metrics: Optional[List[str]] = None,
     export_metrics_file=False,
     metrics_gpu_backend="nvml",
     nwarmup=WARMUP_ROUNDS,
@@ -147,29 +209,34 @@ def get_model_test_metrics(
 ) -> TorchBenchModelMetrics:
     import os
 
+    metrics = frozenset(metrics or ())
     latencies = None
     throughputs = None
     cpu_peak_mem = None
     gpu_peak_mem = None
-    ttfb = None
-    pt2_compilation_time = None
-    pt2_graph_breaks = None
     model_flops = None
     if not (isinstance(model, BenchmarkModel) or isinstance(model, ModelTask)):
         raise ValueError(
             f"Expected BenchmarkModel or ModelTask, get type: {type(model)}"
         )
-    model_pid = (
-        os.getpid() if isinstance(model, BenchmarkModel) else model.worker.proc_pid()
-    )
-    device = (
-        model.device
-        if isinstance(model, BenchmarkModel)
-        else model.get_model_attribute("device")
-    )
+    is_task = isinstance(model, ModelTask)
+
+    def get_attributes(attrs: List[str]) -> Dict[str, Any]:
+        if not attrs:
+            return {}
+        if is_task:
+            return model.get_model_attributes(attrs)
+        return {attr: getattr(model, attr) for attr in attrs}
+
+    model_pid = model.worker.proc_pid() if is_task else os.getpid()
+    device = model.get_model_attribute("device") if is_task else model.device
     if "latencies" in metrics or "throughputs" in metrics:
         latencies = get_latencies(
-            model.invoke, device, nwarmup=nwarmup, num_iter=num_iter
+            model.invoke,
+            device,
+            nwarmup=nwarmup,
+            num_iter=num_iter,
+            in_process=not is_task,
         )
     if "cpu_peak_mem" in metrics or "gpu_peak_mem" in metrics:
         cpu_peak_mem, _device_id, gpu_peak_mem = get_peak_memory(
@@ -181,27 +248,31 @@ def get_model_test_metrics(
             cpu_monitored_pid=model_pid,
         )
     if "throughputs" in metrics:
-        throughputs = [model.batch_size * 1000 / latency for latency in latencies]
-    if "pt2_compilation_time" in metrics:
-        pt2_compilation_time = (
-            model.get_model_attribute("pt2_compilation_time")
-            if isinstance(model, ModelTask)
-            else model.pt2_compilation_time
-        )
-    if "pt2_graph_breaks" in metrics:
-        pt2_graph_breaks = (
-            model.get_model_attribute("pt2_graph_breaks")
-            if isinstance(model, ModelTask)
-            else model.pt2_graph_breaks
-        )
+        latencies_arr = np.asarray(latencies, dtype=np.float64)
+        if (latencies_arr <= 0).any():
+            warnings.warn(
+                f"Non-positive latencies measured, reporting throughput 0 for them: {latencies}"
+            )
+        throughputs = np.divide(
+            model.batch_size * 1000.0,
+            latencies_arr,
+            out=np.zeros_like(latencies_arr),
+            where=latencies_arr > 0,
+        ).tolist()
+    # pt2 compilation stats are only populated after the model has run,
+    #  so fetch them (in one worker round-trip for ModelTask) after the passes above
+    model_attrs = get_attributes(
+        [
+            attr
+            for attr in ("pt2_compilation_time", "pt2_graph_breaks", "ttfb")
+            if attr in metrics
+        ]
+    )
+    pt2_compilation_time = model_attrs.get("pt2_compilation_time")
+    pt2_graph_breaks = model_attrs.get("pt2_graph_breaks")
+    ttfb = model_attrs.get("ttfb")
     if "model_flops" in metrics:
         model_flops = get_model_flops(model)
-    if "ttfb" in metrics:
-        ttfb = (
-            model.get_model_attribute("ttfb")
-            if isinstance(model, ModelTask)
-            else model.ttfb
-        )
     return TorchBenchModelMetrics(
         latencies,
         throughputs,
@@ -214,6 +285,99 @@ def get_model_test_metrics(
     )
 
 
+def _get_model_test_metrics_on_device(
+    device: Optional[str], configs: List[TorchBenchModelConfig], metrics, kwargs
+) -> List[TorchBenchModelMetrics]:
+    import os
+
+    from torchbenchmark.util.experiment.instantiator import load_model_isolated
+
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    result = []
+    for config in configs:
+        if device is not None:
+            # The device pin takes precedence over the config's own extra_env
+            config = dataclasses.replace(
+                config,
+                extra_env={**(config.extra_env or {}), "CUDA_VISIBLE_DEVICES": device},
+            )
+        model = load_model_isolated(config)
+        result.append(get_model_test_metrics(model, metrics=metrics, **kwargs))
+        del model
+    return result
+
+
+def get_model_test_metrics_batch(
+    configs: List[TorchBenchModelConfig],
+    metrics: Optional[List[str]] = None,
+    **kwargs,
+) -> List[TorchBenchModelMetrics]:
+    """Load and measure each model config, spreading the CUDA configs round-robin
+    over the visible CUDA devices with one process per device.
+    Each process pins its device with CUDA_VISIBLE_DEVICES, which overrides
+    any CUDA_VISIBLE_DEVICES set in a config's extra_env. Non-CUDA configs run
+    serially in this process after the CUDA ones, so they do not skew each
+    other's latencies.
+    When running on multiple devices, gpu_peak_mem and export_metrics_file are
+    not supported: the GPU monitor reports the first physical GPU rather than
+    the pinned one, and every process would write the same export file.
+    Results are returned in the same order as `configs`."""
+    import multiprocessing
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    ngpu = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    cuda_indices = [i for i, config in enumerate(configs) if config.device == "cuda"]
+    if ngpu <= 1 or len(cuda_indices) <= 1:
+        return _get_model_test_metrics_on_device(None, configs, metrics, kwargs)
+    if metrics and "gpu_peak_mem" in metrics:
+        raise ValueError(
+            "gpu_peak_mem is not supported when measuring on multiple GPUs in parallel."
+        )
+    if kwargs.get("export_metrics_file"):
+        raise ValueError(
+            "export_metrics_file is not supported when measuring on multiple GPUs in parallel."
+        )
+    # Respect a device restriction already set by the caller
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices:
+        devices = [d.strip() for d in visible_devices.split(",") if d.strip()]
+    else:
+        devices = [str(i) for i in range(ngpu)]
+    devices = devices[:ngpu]
+    result = [None] * len(configs)
+    # CUDA does not support the fork start method
+    with ProcessPoolExecutor(
+        max_workers=len(devices), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = []
+        for device_index, device in enumerate(devices):
+            indices = cuda_indices[device_index :: len(devices)]
+            if not indices:
+                continue
+            future = executor.submit(
+                _get_model_test_metrics_on_device,
+                device,
+                [configs[i] for i in indices],
+                metrics,
+                kwargs,
+            )
+            futures.append((indices, future))
+        for indices, future in futures:
+            for i, metrics_output in zip(indices, future.result()):
+                result[i] = metrics_output
+    other_indices = [
+        i for i, config in enumerate(configs) if not config.device == "cuda"
+    ]
+    other_results = _get_model_test_metrics_on_device(
+        None, [configs[i] for i in other_indices], metrics, kwargs
+    )
+    for i, metrics_output in zip(other_indices, other_results):
+        result[i] = metrics_output
+    return result
+
+
 def get_model_accuracy(
     model_config: TorchBenchModelConfig,
     isolated: bool = True,
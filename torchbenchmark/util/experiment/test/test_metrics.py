@@ -0,0 +1,116 @@
+import concurrent.futures
+import os
+import typing
+from unittest import mock
+
+import torch
+from torch.testing._internal.common_utils import run_tests, TestCase
+
+from torchbenchmark.util.experiment import instantiator, metrics
+from torchbenchmark.util.experiment.instantiator import TorchBenchModelConfig
+
+
+class InlineExecutor:
+    """Runs submitted work in the calling process, in place of ProcessPoolExecutor."""
+
+    def __init__(self, max_workers=None, mp_context=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def fake_get_model_test_metrics(model, metrics=None, **kwargs):
+    # `model` is the config returned by the fake load_model_isolated
+    return (model.name, (model.extra_env or {}).get("CUDA_VISIBLE_DEVICES"))
+
+
+def make_configs(devices: typing.List[str]) -> typing.List[TorchBenchModelConfig]:
+    return [
+        TorchBenchModelConfig(
+            name=f"model_{i}",
+            test="eval",
+            device=device,
+            batch_size=None,
+            extra_args=[],
+        )
+        for i, device in enumerate(devices)
+    ]
+
+
+class TestGetModelTestMetricsBatch(TestCase):
+    def _run_batch(self, configs, ngpu, env, metrics_needed=None, **kwargs):
+        with mock.patch.object(
+            torch.cuda, "is_available", return_value=True
+        ), mock.patch.object(
+            torch.cuda, "device_count", return_value=ngpu
+        ), mock.patch.object(
+            concurrent.futures, "ProcessPoolExecutor", InlineExecutor
+        ), mock.patch.object(
+            instantiator, "load_model_isolated", side_effect=lambda config: config
+        ), mock.patch.object(
+            metrics, "get_model_test_metrics", side_effect=fake_get_model_test_metrics
+        ), mock.patch.dict(
+            os.environ, env, clear=False
+        ):
+            if "CUDA_VISIBLE_DEVICES" not in env:
+                os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+            return metrics.get_model_test_metrics_batch(
+                configs, metrics=metrics_needed or ["latencies"], **kwargs
+            )
+
+    def test_result_order_and_device_mapping(self):
+        configs = make_configs(["cuda"] * 5)
+        result = self._run_batch(configs, ngpu=2, env={})
+        self.assertEqual(
+            result,
+            [
+                ("model_0", "0"),
+                ("model_1", "1"),
+                ("model_2", "0"),
+                ("model_3", "1"),
+                ("model_4", "0"),
+            ],
+        )
+
+    def test_respects_caller_visible_devices(self):
+        configs = make_configs(["cuda"] * 3)
+        result = self._run_batch(configs, ngpu=2, env={"CUDA_VISIBLE_DEVICES": "2,3"})
+        self.assertEqual(
+            result, [("model_0", "2"), ("model_1", "3"), ("model_2", "2")]
+        )
+
+    def test_non_cuda_configs_run_unpinned(self):
+        configs = make_configs(["cpu", "cuda", "cpu", "cuda"])
+        result = self._run_batch(configs, ngpu=2, env={})
+        self.assertEqual(
+            result,
+            [("model_0", None), ("model_1", "0"), ("model_2", None), ("model_3", "1")],
+        )
+
+    def test_single_device_runs_serially(self):
+        configs = make_configs(["cuda"] * 3)
+        result = self._run_batch(configs, ngpu=1, env={})
+        self.assertEqual(result, [("model_0", None), ("model_1", None), ("model_2", None)])
+
+    def test_rejects_gpu_peak_mem(self):
+        configs = make_configs(["cuda"] * 2)
+        with self.assertRaises(ValueError):
+            self._run_batch(configs, ngpu=2, env={}, metrics_needed=["gpu_peak_mem"])
+
+    def test_rejects_export_metrics_file(self):
+        configs = make_configs(["cuda"] * 2)
+        with self.assertRaises(ValueError):
+            self._run_batch(configs, ngpu=2, env={}, export_metrics_file="out.csv")
+
+
+if __name__ == "__main__":
+    run_tests()